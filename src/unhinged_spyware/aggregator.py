@@ -1,11 +1,19 @@
 from __future__ import annotations
 
 import json
-from datetime import datetime, time, timedelta, timezone
-from typing import List, Optional, Sequence, Tuple
+import threading
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 from zoneinfo import ZoneInfo
 
-from .database import get_connection, init_db
+from . import settings
+from .database import from_epoch_us, get_connection, init_db
 
 # =========================
 # Tunables
@@ -17,48 +25,76 @@ MAX_SLEEP_GAP = timedelta(minutes=5)
 SLEEP_HOURS_START = time(21, 0)
 SLEEP_HOURS_END = time(10, 0)
 
+# Sleep window bounds as offsets from the anchor day's local midnight.
+_ONE_DAY = timedelta(days=1)
+_SLEEP_START_OFFSET = timedelta(hours=SLEEP_HOURS_START.hour, minutes=SLEEP_HOURS_START.minute)
+_SLEEP_END_OFFSET = _ONE_DAY + timedelta(hours=SLEEP_HOURS_END.hour, minutes=SLEEP_HOURS_END.minute)
+
+# Durations are judged on local wall-clock time, which can exceed elapsed
+# time by up to a DST shift; SQL prefilters on elapsed time with this slack.
+_DST_SLACK = timedelta(hours=2)
+
+# Sleep windows at least this long get a confidence bonus.
+_LONG_SLEEP_DURATION = timedelta(hours=6)
+
 DOOM_START = time(3, 30)
 DOOM_END = time(6, 0)
 DOOM_MAX_DURATION = timedelta(minutes=20)
 
+# Tunables in epoch-microsecond units, for comparing stored timestamps.
+_US_PER_SECOND = 1_000_000
+_MAX_SLEEP_GAP_US = MAX_SLEEP_GAP // timedelta(microseconds=1)
+_DOOM_MAX_DURATION_US = DOOM_MAX_DURATION // timedelta(microseconds=1)
+
+
+def _time_of_day_us(t: time | datetime) -> int:
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * _US_PER_SECOND + t.microsecond
+
+
+_DOOM_START_US = _time_of_day_us(DOOM_START)
+_DOOM_END_US = _time_of_day_us(DOOM_END)
+
+# Per-user presence events as parallel (timestamp_epoch_us, normalized_status) lists.
+UserEvents = Tuple[List[int], List[str]]
+
+SleepRow = Tuple[int, str, str, int, float]
+AnomalyRow = Tuple[int, str, str, str]
+
 
 # =========================
 # Helpers
 # =========================
 
-def _parse_utc(ts: str) -> datetime:
-    dt = datetime.fromisoformat(ts)
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc)
+@lru_cache(maxsize=64)
+def _zone(name: str) -> ZoneInfo:
+    return ZoneInfo(name)
 
 
 def _overlaps_sleep_window(start_local: datetime, end_local: datetime) -> bool:
     # Anchor sleep window: 21:00 → 10:00
-    anchor_date = (
-        start_local.date()
-        if start_local.time() >= SLEEP_HOURS_END
-        else start_local.date() - timedelta(days=1)
-    )
+    anchor = start_local.replace(hour=0, minute=0, second=0, microsecond=0)
+    if start_local.time() < SLEEP_HOURS_END:
+        anchor -= _ONE_DAY
 
-    window_start = datetime.combine(anchor_date, SLEEP_HOURS_START, tzinfo=start_local.tzinfo)
-    window_end = datetime.combine(anchor_date + timedelta(days=1), SLEEP_HOURS_END, tzinfo=start_local.tzinfo)
+    window_start = anchor + _SLEEP_START_OFFSET
+    window_end = anchor + _SLEEP_END_OFFSET
 
     return max(start_local, window_start) < min(end_local, window_end)
 
 
-def _merge_intervals(
-    intervals: Sequence[Tuple[datetime, datetime]]
-) -> List[Tuple[datetime, datetime]]:
-    merged: List[Tuple[datetime, datetime]] = []
+def _merge_intervals(intervals: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Merge (start, end) epoch-microsecond intervals closer than MAX_SLEEP_GAP.
+    """
+    merged: List[Tuple[int, int]] = []
 
-    for start, end in sorted(intervals, key=lambda x: x[0]):
+    for start, end in sorted(intervals):
         if not merged:
             merged.append((start, end))
             continue
 
         last_start, last_end = merged[-1]
-        if start - last_end <= MAX_SLEEP_GAP:
+        if start - last_end <= _MAX_SLEEP_GAP_US:
             merged[-1] = (last_start, max(last_end, end))
         else:
             merged.append((start, end))
@@ -66,6 +102,37 @@ def _merge_intervals(
     return merged
 
 
+def _load_user_events(conn, user_id: int) -> UserEvents:
+    """
+    Load a user's presence events as parallel, timestamp-sorted lists, so the
+    events of each window can be sliced with bisect instead of a BETWEEN
+    query per window.
+    """
+    rows = conn.execute(
+        """
+        SELECT timestamp_epoch_us, normalized_status
+        FROM presence_events
+        WHERE user_id=?
+        ORDER BY timestamp_epoch_us ASC
+        """,
+        (user_id,),
+    ).fetchall()
+    return [r[0] for r in rows], [r[1] for r in rows]
+
+
+def _slice_events(events: UserEvents, start_us: int, end_us: int) -> UserEvents:
+    # Inclusive on both ends, like SQL BETWEEN.
+    timestamps, statuses = events
+    lo = bisect_left(timestamps, start_us)
+    hi = bisect_right(timestamps, end_us)
+    return timestamps[lo:hi], statuses[lo:hi]
+
+
+def _timezones(conn) -> Dict[int, str]:
+    rows = conn.execute("SELECT user_id, timezone FROM users").fetchall()
+    return {r["user_id"]: r["timezone"] for r in rows}
+
+
 # =========================
 # Core aggregation
 # =========================
@@ -77,262 +144,302 @@ def recompute_offline_intervals(conn) -> None:
     We explicitly do NOT:
     - extend intervals to 'now'
     - create intervals from repeated OFFLINE events
-    """
-
-    conn.execute("DELETE FROM offline_intervals")
-
-    users = conn.execute("SELECT user_id FROM users").fetchall()
 
-    for user in users:
-        user_id = user["user_id"]
-
-        events = conn.execute(
+    Incremental: only events past each user's agg_state watermark are read,
+    resuming from the stored open offline run. An empty agg_state (first run,
+    or cleared by hand to force it) rebuilds from scratch.
+    """
+    cur = conn.cursor()
+
+    watermarks = {
+        r["user_id"]: (r["last_event_id"], r["open_offline_start"])
+        for r in cur.execute("SELECT user_id, last_event_id, open_offline_start FROM agg_state")
+    }
+    if watermarks:
+        # CROSS JOIN pins the join order so each user seeks idx_presence_user_event;
+        # only the new rows are sorted.
+        cur.execute(
             """
-            SELECT timestamp_utc, normalized_status
+            SELECT p.id, p.user_id, p.timestamp_epoch_us, p.normalized_status
+            FROM users u
+            LEFT JOIN agg_state s ON s.user_id = u.user_id
+            CROSS JOIN presence_events p
+            WHERE p.user_id = u.user_id AND p.id > COALESCE(s.last_event_id, 0)
+            ORDER BY p.user_id, p.timestamp_epoch_us ASC
+            """
+        )
+    else:
+        cur.execute("DELETE FROM offline_intervals")
+        # Full rebuild: sort-free, index-only scan of idx_presence_user_epoch_status.
+        cur.execute(
+            """
+            SELECT id, user_id, timestamp_epoch_us, normalized_status
             FROM presence_events
-            WHERE user_id=?
-            ORDER BY timestamp_utc ASC
-            """,
-            (user_id,),
-        ).fetchall()
+            WHERE user_id IN (SELECT user_id FROM users)
+            ORDER BY user_id, timestamp_epoch_us ASC
+            """
+        )
+    pending: List[Tuple[int, str, str, int, int, int]] = []
+    state: List[Tuple[int, int, Optional[int]]] = []
 
-        offline_start: Optional[datetime] = None
+    for user_id, events in groupby(cur, key=itemgetter("user_id")):
+        offline_start: Optional[int]
+        last_event_id, offline_start = watermarks.get(user_id, (0, None))
 
         for ev in events:
-            ts = _parse_utc(ev["timestamp_utc"])
+            last_event_id = max(last_event_id, ev["id"])
             status = ev["normalized_status"]
 
             if status == "offline":
                 # Start offline interval if not already offline
                 if offline_start is None:
-                    offline_start = ts
+                    offline_start = ev["timestamp_epoch_us"]
 
             elif status == "online":
                 # Close offline interval
                 if offline_start is not None:
-                    duration = int((ts - offline_start).total_seconds())
+                    ts = ev["timestamp_epoch_us"]
+                    duration = (ts - offline_start) // _US_PER_SECOND
                     if duration > 0:
-                        conn.execute(
-                            """
-                            INSERT INTO offline_intervals
-                            (user_id, start_utc, end_utc, duration_seconds)
-                            VALUES (?, ?, ?, ?)
-                            """,
+                        pending.append(
                             (
                                 user_id,
-                                offline_start.isoformat(),
-                                ts.isoformat(),
+                                from_epoch_us(offline_start).isoformat(),
+                                from_epoch_us(ts).isoformat(),
+                                offline_start,
+                                ts,
                                 duration,
-                            ),
+                            )
                         )
                     offline_start = None
 
         # NOTE:
-        # If user is still offline at end of data, we intentionally discard
-        # the open interval. Sleep is inferred only once user wakes up.
+        # If user is still offline at end of data, the open interval is not
+        # emitted; it is carried in agg_state until the user wakes up.
+        state.append((user_id, last_event_id, offline_start))
 
+    cur.executemany(
+        """
+        INSERT INTO offline_intervals
+        (user_id, start_utc, end_utc, start_epoch_us, end_epoch_us, duration_seconds)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        pending,
+    )
+    cur.executemany(
+        """
+        INSERT OR REPLACE INTO agg_state (user_id, last_event_id, open_offline_start)
+        VALUES (?, ?, ?)
+        """,
+        state,
+    )
     conn.commit()
 
 
-def _intervals_for_user(conn, user_id: int) -> List[Tuple[datetime, datetime]]:
-    rows = conn.execute(
+def _user_sleep_and_anomalies(
+    conn, user_id: int, tz_name: str
+) -> Tuple[List[SleepRow], List[AnomalyRow]]:
+    """
+    Sleep windows and their doomscroll anomalies for one user. Read-only, so
+    it can run on a worker thread with its own connection.
+    """
+    tz = _zone(tz_name)
+    events = _load_user_events(conn, user_id)
+    intervals = conn.execute(
         """
-        SELECT start_utc, end_utc
+        SELECT start_epoch_us, end_epoch_us
         FROM offline_intervals
-        WHERE user_id=?
-        ORDER BY start_utc ASC
+        WHERE user_id=? AND duration_seconds >= ?
+        ORDER BY start_epoch_us ASC
         """,
-        (user_id,),
+        (user_id, int((MIN_SLEEP_DURATION - _DST_SLACK).total_seconds())),
     ).fetchall()
 
-    return [(_parse_utc(r["start_utc"]), _parse_utc(r["end_utc"])) for r in rows]
+    candidates: List[Tuple[int, int]] = []
 
+    for start_us, end_us in intervals:
+        start_local = from_epoch_us(start_us, tz)
+        end_local = from_epoch_us(end_us, tz)
 
-def recompute_sleep_windows(conn) -> None:
-    conn.execute("DELETE FROM sleep_windows")
+        if end_local - start_local < MIN_SLEEP_DURATION:
+            continue
 
-    users = conn.execute("SELECT user_id, timezone FROM users").fetchall()
+        if not _overlaps_sleep_window(start_local, end_local):
+            continue
 
-    for user in users:
-        user_id = user["user_id"]
-        tz = ZoneInfo(user["timezone"])
+        candidates.append((start_us, end_us))
+
+    sleep_rows: List[SleepRow] = []
+    anomaly_rows: List[AnomalyRow] = []
+
+    for start_us, end_us in _merge_intervals(candidates):
+        start_local = from_epoch_us(start_us, tz)
+        end_local = from_epoch_us(end_us, tz)
+        duration = end_local - start_local
+        duration_minutes = int(duration.total_seconds() // 60)
+        confidence = _compute_confidence(events, start_us, end_us, duration)
+
+        sleep_rows.append(
+            (
+                user_id,
+                start_local.isoformat(),
+                end_local.isoformat(),
+                duration_minutes,
+                confidence,
+            )
+        )
+        anomaly_rows.extend(_detect_doomscroll(events, user_id, start_us, end_us, tz))
 
-        intervals = _intervals_for_user(conn, user_id)
-        candidates: List[Tuple[datetime, datetime]] = []
+    return sleep_rows, anomaly_rows
 
-        for start_utc, end_utc in intervals:
-            start_local = start_utc.astimezone(tz)
-            end_local = end_utc.astimezone(tz)
 
-            if end_local - start_local < MIN_SLEEP_DURATION:
-                continue
+def _per_user_results(
+    conn, timezones: Dict[int, str], max_workers: int
+) -> Iterable[Tuple[List[SleepRow], List[AnomalyRow]]]:
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
 
-            if not _overlaps_sleep_window(start_local, end_local):
-                continue
+    # In-memory databases cannot be shared across connections.
+    if max_workers <= 1 or not path:
+        for user_id, tz_name in timezones.items():
+            yield _user_sleep_and_anomalies(conn, user_id, tz_name)
+        return
 
-            candidates.append((start_local, end_local))
+    # One read-only connection per worker thread; WAL lets them read alongside
+    # the collector. SQLite releases the GIL while executing queries.
+    local = threading.local()
+    readers: List = []
 
-        merged = _merge_intervals(candidates)
+    def task(item: Tuple[int, str]) -> Tuple[List[SleepRow], List[AnomalyRow]]:
+        reader = getattr(local, "conn", None)
+        if reader is None:
+            reader = local.conn = get_connection(Path(path), read_only=True)
+            readers.append(reader)
+        return _user_sleep_and_anomalies(reader, *item)
 
-        for start_local, end_local in merged:
-            duration_minutes = int((end_local - start_local).total_seconds() // 60)
-            confidence = _compute_confidence(conn, user_id, start_local, end_local, tz)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            yield from pool.map(task, timezones.items())
+    finally:
+        for reader in readers:
+            reader.close()
 
-            conn.execute(
-                """
-                INSERT INTO sleep_windows
-                (user_id, sleep_start_local, sleep_end_local, duration_minutes, confidence)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (
-                    user_id,
-                    start_local.isoformat(),
-                    end_local.isoformat(),
-                    duration_minutes,
-                    confidence,
-                ),
-            )
 
+def recompute_sleep_and_anomalies(conn, max_workers: Optional[int] = None) -> None:
+    """
+    Rebuild sleep_windows and anomalies from offline_intervals, one task per
+    user. Results are gathered before the write so the write lock is held
+    only for the final DELETE + executemany.
+    """
+    timezones = _timezones(conn)
+    workers = min(max_workers or settings.AGGREGATOR_WORKERS, max(len(timezones), 1))
+
+    sleep_rows: List[SleepRow] = []
+    anomaly_rows: List[AnomalyRow] = []
+    for user_sleep, user_anomalies in _per_user_results(conn, timezones, workers):
+        sleep_rows.extend(user_sleep)
+        anomaly_rows.extend(user_anomalies)
+
+    cur = conn.cursor()
+    cur.execute("DELETE FROM sleep_windows")
+    cur.executemany(
+        """
+        INSERT INTO sleep_windows
+        (user_id, sleep_start_local, sleep_end_local, duration_minutes, confidence)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        sleep_rows,
+    )
+    cur.execute("DELETE FROM anomalies")
+    cur.executemany(
+        """
+        INSERT INTO anomalies
+        (user_id, type, timestamp_local, metadata_json)
+        VALUES (?, ?, ?, ?)
+        """,
+        anomaly_rows,
+    )
     conn.commit()
 
 
 def _compute_confidence(
-    conn,
-    user_id: int,
-    start_local: datetime,
-    end_local: datetime,
-    tz: ZoneInfo,
+    events: UserEvents, start_us: int, end_us: int, duration: timedelta
 ) -> float:
-    start_utc = start_local.astimezone(timezone.utc)
-    end_utc = end_local.astimezone(timezone.utc)
-
-    events = conn.execute(
-        """
-        SELECT normalized_status
-        FROM presence_events
-        WHERE user_id=? AND timestamp_utc BETWEEN ? AND ?
-        """,
-        (user_id, start_utc.isoformat(), end_utc.isoformat()),
-    ).fetchall()
-
-    statuses = [r["normalized_status"] for r in events]
+    _, statuses = _slice_events(events, start_us, end_us)
 
     score = 0.6
 
-    if not any(s == "online" for s in statuses):
+    if "online" not in statuses:
         score += 0.2
 
-    if (end_local - start_local) >= timedelta(hours=6):
+    # Wall-clock duration, matching the row's duration_minutes.
+    if duration >= _LONG_SLEEP_DURATION:
         score += 0.1
 
-    if any(s == "unknown" for s in statuses):
+    if "unknown" in statuses:
         score -= 0.2
 
     return max(0.0, min(1.0, score))
 
 
-def recompute_anomalies(conn) -> None:
-    conn.execute("DELETE FROM anomalies")
-
-    users = conn.execute("SELECT user_id, timezone FROM users").fetchall()
-
-    for user in users:
-        user_id = user["user_id"]
-        tz = ZoneInfo(user["timezone"])
-
-        windows = conn.execute(
-            """
-            SELECT sleep_start_local, sleep_end_local
-            FROM sleep_windows
-            WHERE user_id=?
-            """,
-            (user_id,),
-        ).fetchall()
-
-        for w in windows:
-            start_local = datetime.fromisoformat(w["sleep_start_local"])
-            end_local = datetime.fromisoformat(w["sleep_end_local"])
-            _detect_doomscroll(conn, user_id, start_local, end_local, tz)
-
-    conn.commit()
-
-
 def _detect_doomscroll(
-    conn,
+    events: UserEvents,
     user_id: int,
-    start_local: datetime,
-    end_local: datetime,
+    start_us: int,
+    end_us: int,
     tz: ZoneInfo,
-) -> None:
-    start_utc = start_local.astimezone(timezone.utc)
-    end_utc = end_local.astimezone(timezone.utc)
-
-    events = conn.execute(
-        """
-        SELECT timestamp_utc, normalized_status
-        FROM presence_events
-        WHERE user_id=? AND timestamp_utc BETWEEN ? AND ?
-        ORDER BY timestamp_utc ASC
-        """,
-        (user_id, start_utc.isoformat(), end_utc.isoformat()),
-    ).fetchall()
-
-    i = 0
-    while i < len(events) - 1:
-        cur = events[i]
-        nxt = events[i + 1]
-
-        if cur["normalized_status"] == "offline" and nxt["normalized_status"] == "online":
-            online_start = _parse_utc(nxt["timestamp_utc"])
-
-            j = i + 2
-            while j < len(events):
-                if events[j]["normalized_status"] == "offline":
-                    online_end = _parse_utc(events[j]["timestamp_utc"])
-                    duration = online_end - online_start
-                    online_start_local = online_start.astimezone(tz)
-
-                    if (
-                        DOOM_START <= online_start_local.time() <= DOOM_END
-                        and duration <= DOOM_MAX_DURATION
-                    ):
-                        conn.execute(
-                            """
-                            INSERT INTO anomalies
-                            (user_id, type, timestamp_local, metadata_json)
-                            VALUES (?, ?, ?, ?)
-                            """,
+) -> List[AnomalyRow]:
+    timestamps, statuses = _slice_events(events, start_us, end_us)
+
+    rows: List[AnomalyRow] = []
+    online_start: Optional[int] = None
+    prev_status: Optional[str] = None
+
+    # Single pass: an OFFLINE → ONLINE step opens a wake-up, the next OFFLINE
+    # closes it (events in between do not matter).
+    for ts, status in zip(timestamps, statuses):
+        if status == "offline":
+            if online_start is not None:
+                duration = ts - online_start
+
+                # Cheap int check first; only short wake-ups need a local time.
+                if duration <= _DOOM_MAX_DURATION_US:
+                    online_start_local = from_epoch_us(online_start, tz)
+
+                    if _DOOM_START_US <= _time_of_day_us(online_start_local) <= _DOOM_END_US:
+                        rows.append(
                             (
                                 user_id,
                                 "doomscroll",
                                 online_start_local.isoformat(),
                                 json.dumps(
                                     {
-                                        "online_duration_minutes": int(duration.total_seconds() // 60),
+                                        "online_duration_minutes": duration // (60 * _US_PER_SECOND),
                                         "wake_time": online_start_local.strftime("%H:%M"),
                                         "return_to_sleep": True,
                                     }
                                 ),
-                            ),
+                            )
                         )
 
-                    i = j
-                    break
-                j += 1
-        i += 1
+                online_start = None
+
+        elif status == "online" and prev_status == "offline" and online_start is None:
+            online_start = ts
+
+        prev_status = status
+
+    return rows
 
 
 def recompute_all(conn=None) -> None:
     conn = conn or get_connection()
     init_db(conn)
     recompute_offline_intervals(conn)
-    recompute_sleep_windows(conn)
-    recompute_anomalies(conn)
+    recompute_sleep_and_anomalies(conn)
 
 
 def main() -> None:
     conn = get_connection()
-    init_db(conn)
     recompute_all(conn)
     print("Aggregation complete.")
 
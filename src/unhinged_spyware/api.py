@@ -1,19 +1,24 @@
 from __future__ import annotations
 
 import json
-from datetime import date, datetime
+import time
+from datetime import date, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
 
+import orjson
 from fastapi import Depends, FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from zoneinfo import ZoneInfo
 
 from . import settings
 from .database import get_connection, init_db
 
-app = FastAPI(title="Sleep Inference API", version="0.1.0")
+app = FastAPI(
+    title="Sleep Inference API",
+    version="0.1.0",
+    default_response_class=ORJSONResponse,
+)
 
 BASE_DIR = Path(__file__).resolve().parent
 FRONTEND_DIR = BASE_DIR / "frontend"
@@ -38,20 +43,50 @@ def get_db():
         conn.close()
 
 
+# Per-process set of known user ids. Users are few and rarely change, so the
+# table is reloaded at most once per TTL. A miss falls back to a primary-key
+# lookup, so new users are found at once and unknown ids never force a reload.
+USER_IDS_CACHE_TTL_SECONDS = 60.0
+_user_ids: frozenset[int] = frozenset()
+_user_ids_expires = 0.0
+
+
+def _user_exists(conn, user_id: int) -> bool:
+    global _user_ids, _user_ids_expires
+    now = time.monotonic()
+    if now >= _user_ids_expires:
+        # Swap in a fresh set so concurrent request threads never see a partial one.
+        _user_ids = frozenset(r[0] for r in conn.execute("SELECT user_id FROM users"))
+        _user_ids_expires = now + USER_IDS_CACHE_TTL_SECONDS
+    if user_id in _user_ids:
+        return True
+    if conn.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,)).fetchone() is None:
+        return False
+    _user_ids = _user_ids | {user_id}
+    return True
+
+
+# Rows per streamed chunk. Starlette hands each chunk of a sync iterator to
+# the threadpool, so per-row chunks would cost a thread hop per row.
+STREAM_BATCH_ROWS = 1000
+
+
+def _stream_json_array(cursor) -> Iterator[bytes]:
+    # Encode one fetchmany() batch per chunk so large responses are never
+    # built in memory.
+    sep = b"["
+    while rows := cursor.fetchmany(STREAM_BATCH_ROWS):
+        yield sep + b",".join([orjson.dumps(dict(r)) for r in rows])
+        sep = b","
+    yield b"[]" if sep == b"[" else b"]"
+
+
 @app.get("/users")
 def list_users(conn=Depends(get_db)) -> List[Dict[str, Any]]:
     rows = conn.execute(
         "SELECT user_id, username, full_name, timezone FROM users ORDER BY user_id"
     ).fetchall()
-    return [
-        {
-            "user_id": r["user_id"],
-            "username": r["username"],
-            "full_name": r["full_name"],
-            "timezone": r["timezone"],
-        }
-        for r in rows
-    ]
+    return [dict(r) for r in rows]
 
 
 @app.get("/users/{user_id}/sleep")
@@ -61,37 +96,33 @@ def get_sleep_windows(
     to_date: Optional[date] = Query(None, alias="to"),
     conn=Depends(get_db),
 ) -> Dict[str, Any]:
-    user = conn.execute("SELECT timezone FROM users WHERE user_id=?", (user_id,)).fetchone()
-    if not user:
+    if not _user_exists(conn, user_id):
         raise HTTPException(status_code=404, detail="User not found")
-    tz = ZoneInfo(user["timezone"])
+
+    # Stored local timestamps are ISO strings in the user's timezone, so a
+    # local-date range is a plain string range on the column.
+    params: list[Any] = [user_id]
+    clause = ""
+    if from_date:
+        clause += " AND {col} >= ?"
+        params.append(from_date.isoformat())
+    if to_date:
+        clause += " AND {col} < ?"
+        params.append((to_date + timedelta(days=1)).isoformat())
+
     windows = conn.execute(
-        "SELECT sleep_start_local, sleep_end_local, duration_minutes, confidence FROM sleep_windows WHERE user_id=? ORDER BY sleep_start_local",
-        (user_id,),
+        "SELECT sleep_start_local AS start, sleep_end_local AS \"end\", "
+        "duration_minutes AS durationMinutes, confidence FROM sleep_windows "
+        f"WHERE user_id=?{clause.format(col='sleep_start_local')} ORDER BY sleep_start_local",
+        params,
     ).fetchall()
     anomalies = conn.execute(
-        "SELECT type, timestamp_local, metadata_json FROM anomalies WHERE user_id=? ORDER BY timestamp_local",
-        (user_id,),
+        "SELECT type, timestamp_local, metadata_json FROM anomalies "
+        f"WHERE user_id=?{clause.format(col='timestamp_local')} ORDER BY timestamp_local",
+        params,
     ).fetchall()
 
-    def _filter_by_date(dt_str: str) -> bool:
-        dt = datetime.fromisoformat(dt_str).astimezone(tz)
-        if from_date and dt.date() < from_date:
-            return False
-        if to_date and dt.date() > to_date:
-            return False
-        return True
-
-    windows_payload = [
-        {
-            "start": w["sleep_start_local"],
-            "end": w["sleep_end_local"],
-            "durationMinutes": w["duration_minutes"],
-            "confidence": w["confidence"],
-        }
-        for w in windows
-        if _filter_by_date(w["sleep_start_local"])
-    ]
+    windows_payload = [dict(w) for w in windows]
     anomalies_payload = [
         {
             "type": a["type"],
@@ -99,7 +130,6 @@ def get_sleep_windows(
             "metadata": json.loads(a["metadata_json"]) if a["metadata_json"] else {},
         }
         for a in anomalies
-        if _filter_by_date(a["timestamp_local"])
     ]
     return {"windows": windows_payload, "anomalies": anomalies_payload}
 
@@ -111,8 +141,9 @@ def get_presence(
     to_ts: Optional[str] = Query(None, alias="to"),
     status: Optional[str] = Query(None, description="Filter by normalized status (e.g., online)"),
     limit: int = Query(1000, ge=1, le=5000),
-    conn=Depends(get_db),
-) -> List[Dict[str, Any]]:
+    # Request scope keeps the connection open until the streamed body is sent.
+    conn=Depends(get_db, scope="request"),
+) -> StreamingResponse:
     params: list[Any] = [user_id]
     clause = ""
     if from_ts:
@@ -125,24 +156,23 @@ def get_presence(
         clause += " AND normalized_status = ?"
         params.append(status)
     params.append(limit)
-    rows = conn.execute(
+    # Latest `limit` events, returned oldest first.
+    cursor = conn.execute(
         f"""
-        SELECT timestamp_utc, raw_status, normalized_status
-        FROM presence_events
-        WHERE user_id=? {clause}
-        ORDER BY timestamp_utc DESC
-        LIMIT ?
+        SELECT t.timestamp_utc AS timestamp, t.raw_status AS rawStatus,
+               t.normalized_status AS normalizedStatus
+        FROM (
+            SELECT id, timestamp_utc, raw_status, normalized_status
+            FROM presence_events
+            WHERE user_id=? {clause}
+            ORDER BY timestamp_utc DESC
+            LIMIT ?
+        ) AS t
+        ORDER BY t.timestamp_utc ASC, t.id ASC
         """,
         params,
-    ).fetchall()
-    return [
-        {
-            "timestamp": r["timestamp_utc"],
-            "rawStatus": r["raw_status"],
-            "normalizedStatus": r["normalized_status"],
-        }
-        for r in reversed(rows)
-    ]
+    )
+    return StreamingResponse(_stream_json_array(cursor), media_type="application/json")
 
 
 @app.get("/presence/online")
@@ -152,7 +182,8 @@ def get_recent_online(
 ) -> List[Dict[str, Any]]:
     rows = conn.execute(
         """
-        SELECT user_id, timestamp_utc, raw_status, normalized_status
+        SELECT user_id AS userId, timestamp_utc AS timestamp, raw_status AS rawStatus,
+               normalized_status AS normalizedStatus
         FROM presence_events
         WHERE normalized_status = 'online'
         ORDER BY timestamp_utc DESC
@@ -160,15 +191,7 @@ def get_recent_online(
         """,
         (limit,),
     ).fetchall()
-    return [
-        {
-            "userId": r["user_id"],
-            "timestamp": r["timestamp_utc"],
-            "rawStatus": r["raw_status"],
-            "normalizedStatus": r["normalized_status"],
-        }
-        for r in rows
-    ]
+    return [dict(r) for r in rows]
 
 
 def main() -> None:
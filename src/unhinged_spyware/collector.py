@@ -7,7 +7,7 @@ from pyrogram.enums import UserStatus
 from pyrogram.handlers import RawUpdateHandler
 
 from . import settings
-from .database import ensure_users, get_connection, init_db
+from .database import ensure_users, get_connection, init_db, to_epoch_us
 
 
 def _valid_session_string(raw_value: str | None) -> str | None:
@@ -111,14 +111,15 @@ async def run_collector() -> None:
                 return
             await ensure_user_row(update.user_id)
             raw_status, normalized = _normalize_raw_status(update.status)
-            ts = datetime.now(timezone.utc).isoformat()
+            now = datetime.now(timezone.utc)
             try:
                 conn.execute(
                     """
-                    INSERT INTO presence_events (user_id, timestamp_utc, raw_status, normalized_status)
-                    VALUES (?, ?, ?, ?)
+                    INSERT INTO presence_events
+                    (user_id, timestamp_utc, timestamp_epoch_us, raw_status, normalized_status)
+                    VALUES (?, ?, ?, ?, ?)
                     """,
-                    (update.user_id, ts, raw_status, normalized),
+                    (update.user_id, now.isoformat(), to_epoch_us(now), raw_status, normalized),
                 )
                 conn.commit()
             except Exception as exc:  # noqa: BLE001
@@ -1,27 +1,80 @@
 from __future__ import annotations
 
 import sqlite3
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Iterable
 
 from . import settings
 
+# Bump whenever init_db's schema/migration steps change; existing databases
+# below this version re-run them once.
+SCHEMA_VERSION = 3
 
-def get_connection(path: Path | None = None) -> sqlite3.Connection:
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def to_epoch_us(dt: datetime) -> int:
+    """Aware datetime → integer microseconds since the Unix epoch."""
+    return (dt - _EPOCH) // _MICROSECOND
+
+
+def from_epoch_us(us: int, tz=timezone.utc) -> datetime:
+    """Integer microseconds since the Unix epoch → aware datetime in `tz`."""
+    dt = _EPOCH + timedelta(microseconds=us)
+    return dt if tz is timezone.utc else dt.astimezone(tz)
+
+
+def get_connection(path: Path | None = None, read_only: bool = False) -> sqlite3.Connection:
     db_path = path or settings.DB_PATH
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    if read_only:
+        conn = sqlite3.connect(
+            f"{Path(db_path).resolve().as_uri()}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=512,
+        )
+    else:
+        conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=512)
     conn.row_factory = sqlite3.Row
     # Reduce lock contention between writer (collector) and periodic aggregations.
     conn.execute("PRAGMA busy_timeout = 5000")
-    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    if not read_only:
+        conn.execute("PRAGMA journal_mode = WAL")
+    # WAL stays crash-safe without an fsync per commit; the aggregator's full
+    # rescans benefit from a larger page cache and memory-mapped reads.
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -65536")
+    conn.execute("PRAGMA mmap_size = 268435456")
     return conn
 
 
+# Database files already initialized by this process.
+_initialized_paths: set[str] = set()
+
+
 def init_db(conn: sqlite3.Connection) -> None:
+    # Cheap after the first call per database file: the API calls this per request.
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    if path and path in _initialized_paths:
+        return
+
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        _migrate(conn)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    _backfill_presence_epochs(conn)
+    conn.commit()
+
+    if path:
+        _initialized_paths.add(path)
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
     conn.executescript(
         """
-        PRAGMA foreign_keys = ON;
-
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -33,6 +86,7 @@ def init_db(conn: sqlite3.Connection) -> None:
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             timestamp_utc DATETIME NOT NULL,
+            timestamp_epoch_us INTEGER,
             raw_status TEXT NOT NULL,
             normalized_status TEXT NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(user_id)
@@ -41,11 +95,21 @@ def init_db(conn: sqlite3.Connection) -> None:
         CREATE INDEX IF NOT EXISTS idx_presence_user_time
             ON presence_events(user_id, timestamp_utc);
 
+        -- Lets the aggregator seek straight to a user's unprocessed events.
+        CREATE INDEX IF NOT EXISTS idx_presence_user_event
+            ON presence_events(user_id, id);
+
+        -- Status filter + time order for the most-recent-online feed.
+        CREATE INDEX IF NOT EXISTS idx_presence_norm_time
+            ON presence_events(normalized_status, timestamp_utc DESC);
+
         CREATE TABLE IF NOT EXISTS offline_intervals (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             start_utc DATETIME NOT NULL,
             end_utc DATETIME NOT NULL,
+            start_epoch_us INTEGER,
+            end_epoch_us INTEGER,
             duration_seconds INTEGER NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(user_id)
         );
@@ -68,15 +132,62 @@ def init_db(conn: sqlite3.Connection) -> None:
             metadata_json TEXT,
             FOREIGN KEY (user_id) REFERENCES users(user_id)
         );
+
+        -- Incremental offline-interval state: last presence event folded in
+        -- and the start of a still-open offline run (epoch µs), per user.
+        CREATE TABLE IF NOT EXISTS agg_state (
+            user_id INTEGER PRIMARY KEY,
+            last_event_id INTEGER NOT NULL,
+            open_offline_start INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        );
         """
     )
     # Backfill new columns for existing installs; ignore if they already exist.
-    try:
-        conn.execute("ALTER TABLE users ADD COLUMN full_name TEXT")
-    except sqlite3.OperationalError:
-        pass
+    for statement in (
+        "ALTER TABLE users ADD COLUMN full_name TEXT",
+        "ALTER TABLE presence_events ADD COLUMN timestamp_epoch_us INTEGER",
+        "ALTER TABLE offline_intervals ADD COLUMN start_epoch_us INTEGER",
+        "ALTER TABLE offline_intervals ADD COLUMN end_epoch_us INTEGER",
+    ):
+        try:
+            conn.execute(statement)
+        except sqlite3.OperationalError:
+            pass
 
-    conn.commit()
+    conn.executescript(
+        """
+        -- Covering index for the aggregator's per-user ordered scans.
+        CREATE INDEX IF NOT EXISTS idx_presence_user_epoch_status
+            ON presence_events(user_id, timestamp_epoch_us, normalized_status);
+
+        -- Keeps the epoch backfill below cheap once everything is converted.
+        CREATE INDEX IF NOT EXISTS idx_presence_epoch_missing
+            ON presence_events(id) WHERE timestamp_epoch_us IS NULL;
+
+        -- Covers the aggregator's per-user, start-ordered interval reads.
+        CREATE INDEX IF NOT EXISTS idx_offline_user_start
+            ON offline_intervals(user_id, start_epoch_us, duration_seconds, end_epoch_us);
+
+        -- Superseded by idx_presence_user_epoch_status.
+        DROP INDEX IF EXISTS idx_presence_user_time_status;
+        """
+    )
+
+
+def _backfill_presence_epochs(conn: sqlite3.Connection) -> None:
+    rows = conn.execute(
+        "SELECT id, timestamp_utc FROM presence_events WHERE timestamp_epoch_us IS NULL"
+    ).fetchall()
+    if not rows:
+        return
+    updates = []
+    for row in rows:
+        dt = datetime.fromisoformat(row["timestamp_utc"])
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        updates.append((to_epoch_us(dt), row["id"]))
+    conn.executemany("UPDATE presence_events SET timestamp_epoch_us=? WHERE id=?", updates)
 
 
 def ensure_users(conn: sqlite3.Connection, user_timezones: dict[int, str]) -> None:
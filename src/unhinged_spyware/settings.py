@@ -40,6 +40,7 @@ TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
 USER_TIMEZONES = _parse_user_timezones(os.environ.get("USER_TIMEZONES", ""))
 POLL_INTERVAL_SECONDS = int(os.environ.get("POLL_INTERVAL_SECONDS", "30"))
+AGGREGATOR_WORKERS = int(os.environ.get("AGGREGATOR_WORKERS", str(os.cpu_count() or 1)))
 
 FASTAPI_HOST = os.environ.get("FASTAPI_HOST", "0.0.0.0")
 FASTAPI_PORT = int(os.environ.get("FASTAPI_PORT", "8000"))